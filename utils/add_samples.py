@@ -1,13 +1,38 @@
+import csv
 import json
 import random
+import sys
 import argparse
-import pandas as pd
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def load_jsonl(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return [json.loads(line) for line in f]
+    with open(file_path, 'rb') as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    # Parse all records in one call instead of one call per line
+    payload = b'[' + b','.join(lines) + b']'
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+def dump_jsonl(rows):
+    """Serialize rows into a single UTF-8 encoded JSONL payload."""
+    if orjson is not None:
+        lines = [orjson.dumps(row) for row in rows]
+    else:
+        # Compact separators so the output matches orjson byte for byte
+        lines = [json.dumps(row, ensure_ascii=False,
+                            separators=(',', ':')).encode('utf-8')
+                 for row in rows]
+    if not lines:
+        return b''
+    return b'\n'.join(lines) + b'\n'
 
 
 def load_bio_file(bio_file_path):
@@ -18,12 +43,54 @@ def load_bio_file(bio_file_path):
         with open(bio_file_path, 'r', encoding='utf-8') as f:
             return json.load(f)
     elif bio_file_path.endswith('.csv'):
-        df = pd.read_csv(bio_file_path)
-        return df.to_dict('records')
+        with open(bio_file_path, 'r', newline='', encoding='utf-8-sig') as f:
+            return list(csv.DictReader(f))
     else:
         raise ValueError("Unknown bio file format")
 
 
+def fast_distractors(pool_list, forbidden_set, k, max_attempts=None):
+    """Pick up to k unique items outside forbidden_set by rejection sampling."""
+    if max_attempts is None:
+        max_attempts = 20 * k
+    picked = {}
+    for _ in range(max_attempts):
+        if len(picked) >= k:
+            break
+        item = pool_list[random.randrange(len(pool_list))]
+        if item not in forbidden_set and item not in picked:
+            picked[item] = None
+    return list(picked)
+
+
+def sample_without(pool_list, excluded_set, k):
+    """Sample up to k unique items from pool_list that are not excluded."""
+    if not isinstance(excluded_set, (set, frozenset)):
+        # Membership tests against a list would make every pass O(P*T)
+        excluded_set = set(excluded_set)
+    available = len(pool_list) - len(excluded_set)
+    if 2 * k <= available:
+        # Sparse case: draw indices with a margin for excluded hits, so
+        # only O(k) pool entries are ever touched
+        candidate_idx = random.sample(
+            range(len(pool_list)), min(len(pool_list), 2 * k)
+        )
+        picked = [pool_list[i] for i in candidate_idx
+                  if pool_list[i] not in excluded_set]
+        if len(picked) < k:
+            picked += fast_distractors(
+                pool_list, excluded_set.union(picked), k - len(picked)
+            )
+        if len(picked) >= k:
+            return picked[:k]
+
+    # Dense case (or rejection sampling gave up): filter the pool once
+    possible = [x for x in pool_list if x not in excluded_set]
+    if len(possible) <= k:
+        return possible
+    return random.sample(possible, k)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Add more samples to existing annotation file"
@@ -67,7 +134,16 @@ def main():
     # Load model outputs and bio data (same logic as prepare_data.py)
     print(f"Loading model outputs from {args.model_outputs}...")
     model_data = load_jsonl(args.model_outputs)
-    model_lookup = {item['character_json']: item for item in model_data}
+    # Flatten to id -> English keywords once, instead of per bio item.
+    # Keywords repeat across characters, so intern them to share one
+    # string object per keyword in every later set operation.
+    english_kw = {
+        item['character_json']: [
+            sys.intern(keyword) for keyword in
+            item.get('personality_keywords', {}).get('English', [])
+        ]
+        for item in model_data
+    }
 
     # Use default bio file if not provided
     if args.bio_file is None:
@@ -81,19 +157,16 @@ def main():
     available_data = []
     all_keywords_pool = set()
 
-    for bio_item in bio_data:
-        char_id = (bio_item.get('character_json') or
-                   bio_item.get('id'))
-        if not char_id or char_id in used_ids:
-            continue
-
-        if char_id in model_lookup:
-            model_item = model_lookup[char_id]
-
-            # Extract English keywords
-            keywords = (model_item.get('personality_keywords', {})
-                        .get('English', []))
+    bio_ids = [bio_item.get('character_json') or bio_item.get('id')
+               for bio_item in bio_data]
+    # Unused characters that also have model outputs, in one set operation
+    candidate_ids = set(english_kw).intersection(
+        char_id for char_id in bio_ids if char_id
+    ) - used_ids
 
+    for char_id, bio_item in zip(bio_ids, bio_data):
+        if char_id in candidate_ids:
+            keywords = english_kw[char_id]
             if keywords:
                 name = (bio_item.get('character_name') or
                         bio_item.get('name', 'Unknown'))
@@ -117,11 +190,12 @@ def main():
         sampled_data = random.sample(available_data, args.num_samples)
 
     # Generate candidates for new samples
-    all_keywords_list = list(all_keywords_pool)
-    new_rows = []
+    all_keywords_list = tuple(all_keywords_pool)
+    candidates_list = []
 
     for item in sampled_data:
         true_keywords = item['model_keywords']
+        true_set = set(true_keywords)
 
         num_true = len(true_keywords)
         num_distractors = args.candidate_pool_size - num_true
@@ -135,38 +209,34 @@ def main():
                 true_keywords, args.candidate_pool_size
             )
         else:
-            possible_distractors = [
-                k for k in all_keywords_list
-                if k not in true_keywords
-            ]
-            if len(possible_distractors) < num_distractors:
-                distractors = possible_distractors
-            else:
-                distractors = random.sample(
-                    possible_distractors, num_distractors
-                )
+            distractors = sample_without(
+                all_keywords_list, true_set, num_distractors
+            )
 
             candidates = true_keywords + distractors
 
         random.shuffle(candidates)
 
         candidates.append("None of the above")
+        candidates_list.append(candidates)
 
-        display_text = (f"<h1>{item['name']}</h1>"
-                        f"<p>{item['biography']}</p>")
-
-        new_rows.append({
+    texts = [f"<h1>{item['name']}</h1><p>{item['biography']}</p>"
+             for item in sampled_data]
+    new_rows = [
+        {
             "id": item['id'],
-            "text": display_text,
+            "text": text,
             "candidates": candidates,
-            "model_keywords": true_keywords,
-        })
+            "model_keywords": item['model_keywords'],
+        }
+        for item, text, candidates in zip(sampled_data, texts,
+                                          candidates_list)
+    ]
 
     # Append to existing file
     print(f"Appending {len(new_rows)} new samples to {args.existing_file}...")
-    with open(args.existing_file, 'a', encoding='utf-8') as f:
-        for row in new_rows:
-            f.write(json.dumps(row, ensure_ascii=False) + '\n')
+    with open(args.existing_file, 'ab') as f:
+        f.write(dump_jsonl(new_rows))
 
     print(f"Successfully added {len(new_rows)} new samples. "
           f"Total samples: {len(existing_data) + len(new_rows)}")
@@ -5,50 +5,64 @@ Compute overlap metrics between human annotations and model keywords.
 import json
 import os
 from collections import defaultdict
-from typing import Dict, List, Set
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, FrozenSet, List, Set
 
+import numpy as np
+import pandas as pd
 
-def load_jsonl(file_path: str) -> List[Dict]:
-    """Load a JSONL file."""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return [json.loads(line.strip()) for line in f if line.strip()]
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NONE_OF_THE_ABOVE = frozenset({"None of the above"})
 
+# The parent still unpickles every user's results (~0.6x the serial metric
+# time) and spawned workers re-import numpy/pandas (~0.7 s), so the process
+# pool only pays off for large inputs spread over several workers
+PARALLEL_MIN_ANNOTATIONS = 500_000
+PARALLEL_MIN_WORKERS = 4
 
-def extract_model_keywords(instance: Dict) -> Set[str]:
-    """Extract model keywords from original data instance."""
-    return set(instance.get('model_keywords', []))
+
+def load_jsonl(file_path: str) -> List[Dict]:
+    """Load a JSONL file."""
+    with open(file_path, 'rb') as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    # Parse all records in one call instead of one call per line
+    payload = b'[' + b','.join(lines) + b']'
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
 
 
 def extract_annotated_keywords(instance: Dict) -> Set[str]:
     """Extract annotated keywords from annotation instance."""
     label_annotations = instance.get('label_annotations', {})
-    valid_keywords = label_annotations.get('valid_keywords', {})
+    return set(label_annotations.get('valid_keywords', {})) - NONE_OF_THE_ABOVE
 
-    keywords = set()
-    for keyword in valid_keywords.keys():
-        if keyword != "None of the above":
-            keywords.add(keyword)
 
-    return keywords
+def compute_metrics(predicted_sizes: np.ndarray, actual_sizes: np.ndarray,
+                    intersection_sizes: np.ndarray) -> Dict[str, np.ndarray]:
+    """Compute precision, recall, F1, and Jaccard similarity for many instances at once."""
+    predicted_sizes = np.asarray(predicted_sizes, dtype=float)
+    actual_sizes = np.asarray(actual_sizes, dtype=float)
+    intersection_sizes = np.asarray(intersection_sizes, dtype=float)
+    union_sizes = predicted_sizes + actual_sizes - intersection_sizes
 
+    def safe_divide(numerator, denominator):
+        return np.divide(numerator, denominator,
+                         out=np.zeros_like(numerator), where=denominator > 0)
 
-def compute_metrics(predicted: Set[str], actual: Set[str]) -> Dict[str, float]:
-    """Compute precision, recall, F1, and Jaccard similarity."""
-    if not predicted and not actual:
-        return {
-            'precision': 1.0,
-            'recall': 1.0,
-            'f1': 1.0,
-            'jaccard': 1.0
-        }
+    precision = safe_divide(intersection_sizes, predicted_sizes)
+    recall = safe_divide(intersection_sizes, actual_sizes)
+    f1 = safe_divide(2 * precision * recall, precision + recall)
+    jaccard = safe_divide(intersection_sizes, union_sizes)
 
-    intersection = predicted & actual
-    union = predicted | actual
-
-    precision = len(intersection) / len(predicted) if predicted else 0.0
-    recall = len(intersection) / len(actual) if actual else 0.0
-    f1 = 2 * precision * recall / (precision + recall) if (precision + recall) > 0 else 0.0
-    jaccard = len(intersection) / len(union) if union else 0.0
+    # Two empty keyword sets count as a perfect match
+    both_empty = union_sizes == 0
+    for values in (precision, recall, f1, jaccard):
+        values[both_empty] = 1.0
 
     return {
         'precision': precision,
@@ -63,51 +77,53 @@ def compute_aggregate_metrics(all_metrics: List[Dict[str, float]]) -> Dict[str,
     if not all_metrics:
         return {}
 
-    aggregate = defaultdict(list)
+    # Welford's running (count, mean, M2) per metric: one pass, O(1) memory,
+    # without the cancellation of the sum-of-squares formula. The plain sum
+    # is kept as well so the reported mean is exactly sum / count.
+    aggregate = defaultdict(lambda: [0, 0.0, 0.0, 0.0])
     for metrics in all_metrics:
         for key, value in metrics.items():
             if isinstance(value, (int, float)):
-                aggregate[key].append(value)
+                totals = aggregate[key]
+                totals[0] += 1
+                totals[1] += value
+                delta = value - totals[2]
+                totals[2] += delta / totals[0]
+                totals[3] += delta * (value - totals[2])
 
     result = {}
-    for key, values in aggregate.items():
-        if values:
-            result[f'{key}_mean'] = sum(values) / len(values)
-            result[f'{key}_std'] = (
-                sum((x - result[f'{key}_mean'])**2 for x in values) / len(values)
-            ) ** 0.5
+    for key, (count, total, _, m2) in aggregate.items():
+        if count:
+            result[f'{key}_mean'] = total / count
+            result[f'{key}_std'] = (m2 / count) ** 0.5
 
     return result
 
 
-def compute_user_metrics(user_annotations: List[Dict], original_lookup: Dict[str, Dict]) -> Dict:
-    """Compute metrics for a single user."""
-    user_metrics = []
-    per_instance_results = []
-    total_instances = 0
-
-    for annotated_instance in user_annotations:
-        instance_id = annotated_instance.get('instance_id') or annotated_instance.get('id')
-        if not instance_id:
-            continue
-
-        if instance_id not in original_lookup:
-            continue
-
-        original_instance = original_lookup[instance_id]
+def compute_user_metrics(instance_ids: List[str], annotated_keyword_sets: List[Set[str]],
+                         model_kw_lookup: Dict[str, FrozenSet[str]]) -> Dict:
+    """Compute metrics for a single user's annotations against the model keywords."""
+    model_keyword_sets = [model_kw_lookup[instance_id] for instance_id in instance_ids]
 
-        model_keywords = extract_model_keywords(original_instance)
-        annotated_keywords = extract_annotated_keywords(annotated_instance)
+    total_instances = len(instance_ids)
+    batch_metrics = compute_metrics(
+        [len(annotated) for annotated in annotated_keyword_sets],
+        [len(model) for model in model_keyword_sets],
+        [len(annotated & model)
+         for annotated, model in zip(annotated_keyword_sets, model_keyword_sets)]
+    )
+    metric_columns = {key: values.tolist() for key, values in batch_metrics.items()}
 
-        metrics = compute_metrics(annotated_keywords, model_keywords)
-
-        total_instances += 1
+    user_metrics = []
+    per_instance_results = []
+    for i, instance_id in enumerate(instance_ids):
+        metrics = {key: values[i] for key, values in metric_columns.items()}
         user_metrics.append(metrics)
 
         per_instance_results.append({
             'instance_id': instance_id,
-            'model_keywords': sorted(list(model_keywords)),
-            'annotated_keywords': sorted(list(annotated_keywords)),
+            'model_keywords': list(model_keyword_sets[i]),
+            'annotated_keywords': list(annotated_keyword_sets[i]),
             'metrics': metrics
         })
 
@@ -120,6 +136,22 @@ def compute_user_metrics(user_annotations: List[Dict], original_lookup: Dict[str
     }
 
 
+# Read-only model keyword lookup installed once per worker process
+_worker_model_kw_lookup: Dict[str, FrozenSet[str]] = {}
+
+
+def _init_worker(model_kw_lookup: Dict[str, FrozenSet[str]]) -> None:
+    """Install the shared model keyword lookup in a worker process."""
+    global _worker_model_kw_lookup
+    _worker_model_kw_lookup = model_kw_lookup
+
+
+def _compute_user_metrics_worker(user_payload) -> Dict:
+    """Compute one user's metrics in a worker using the installed lookup."""
+    instance_ids, annotated_keyword_sets = user_payload
+    return compute_user_metrics(instance_ids, annotated_keyword_sets, _worker_model_kw_lookup)
+
+
 def main():
     original_data_path = "data/keyword_annotation_qwen3_32b_fp8.jsonl"
     annotated_data_path = "annotation_output/keyword_annotation_qwen3_32b_fp8/annotated_instances.jsonl"
@@ -129,22 +161,51 @@ def main():
 
     # Load data
     original_data = load_jsonl(original_data_path)
-    original_lookup = {item['id']: item for item in original_data}
+    # Build each character's keyword set once, however many users annotated it
+    model_kw_lookup = {item['id']: frozenset(item.get('model_keywords', []))
+                       for item in original_data}
 
     annotated_data = load_jsonl(annotated_data_path)
 
-    # Group annotations by user_id
-    user_to_annotations = defaultdict(list)
-    for annotated_instance in annotated_data:
-        user_id = annotated_instance.get('user_id')
-        if user_id:
-            user_to_annotations[user_id].append(annotated_instance)
+    annotations_df = pd.DataFrame({
+        'user_id': [inst.get('user_id') for inst in annotated_data],
+        'instance_id': [inst.get('instance_id') or inst.get('id') for inst in annotated_data],
+        'annotated_keywords': [extract_annotated_keywords(inst) for inst in annotated_data],
+    })
+    user_ids = annotations_df['user_id']
+    annotations_df = annotations_df[user_ids.notna() & (user_ids != '')]
+
+    # Rows whose instance is missing from the original data are not scored,
+    # but their users are still reported with zero instances
+    annotations_df = annotations_df.assign(
+        matched=annotations_df['instance_id'].isin(pd.Index(list(model_kw_lookup)))
+    )
+
+    # Workers only receive instance ids and annotated sets per user; the model
+    # keyword lookup is installed once per process through the initializer.
+    # groupby sorts users and keeps annotation order.
+    user_order = []
+    user_payloads = []
+    for user_id, user_annotations in annotations_df.groupby('user_id', sort=True):
+        user_annotations = user_annotations[user_annotations['matched']]
+        user_order.append(user_id)
+        user_payloads.append((user_annotations['instance_id'].tolist(),
+                              user_annotations['annotated_keywords'].tolist()))
+
+    max_workers = min(len(user_payloads), os.cpu_count() or 1)
+    total_matched = int(annotations_df['matched'].sum())
+    if max_workers >= PARALLEL_MIN_WORKERS and total_matched >= PARALLEL_MIN_ANNOTATIONS:
+        chunksize = max(1, len(user_payloads) // (4 * max_workers))
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(model_kw_lookup,)) as executor:
+            results = list(executor.map(_compute_user_metrics_worker, user_payloads,
+                                        chunksize=chunksize))
+    else:
+        results = [compute_user_metrics(instance_ids, annotated_keyword_sets, model_kw_lookup)
+                   for instance_ids, annotated_keyword_sets in user_payloads]
 
-    # Compute metrics per user
     user_results = {}
-    for user_id in sorted(user_to_annotations.keys()):
-        user_annotations = user_to_annotations[user_id]
-        user_result = compute_user_metrics(user_annotations, original_lookup)
+    for user_id, user_result in zip(user_order, results):
         user_results[user_id] = user_result
 
         agg = user_result['aggregate_metrics']
@@ -177,8 +238,18 @@ def main():
         'per_user': user_results
     }
 
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(output_data, f, indent=2, ensure_ascii=False)
+    # Sort keyword lists in place only when serializing, for stable output
+    for user_result in user_results.values():
+        for inst_result in user_result['per_instance']:
+            inst_result['model_keywords'].sort()
+            inst_result['annotated_keywords'].sort()
+
+    if orjson is not None:
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(output_data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(output_data, f, indent=2, ensure_ascii=False)
     print(f"\nResults saved to {output_path}")
 
 